@@ -10,13 +10,12 @@ see also https://decentespresso.com/decentscale_api
 __version__ = "0.1.0"
 
 import asyncio
-import binascii
 import functools
 import logging
-import operator
+import struct
 import threading
-import time
-from itertools import cycle
+from binascii import hexlify as _hexlify
+from time import time as _now
 
 from bleak import BleakScanner, BleakClient
 
@@ -25,16 +24,57 @@ logger = logging.getLogger(__name__)
 
 FIRMWARE_VERSION = {0xFE: 'v1.0', 0x02: 'v1.1'}
 
+# Notification: header, type, signed big-endian short (weight in 1/10 g), two data bytes, XOR
+_PACKET_STRUCT = struct.Struct('>BBhBBB')
+
 
 class AsyncioEventLoopThread(threading.Thread):
     def __init__(self, *args, loop=None, **kwargs):
         super().__init__(*args, **kwargs)
-        self.loop = asyncio.new_event_loop()
+        self.loop = None  # created by start()
         self.running = False
+        self._thread = self
+        self._tasks = set()  # tasks created by _run, referenced until done
 
     def run(self):
+        loop = self.loop
+        try:
+            loop.run_forever()
+            # Let pending tasks (e.g. the disconnect scheduled by stop()) finish
+            pending = asyncio.all_tasks(loop)
+            if pending:
+                _, pending = loop.run_until_complete(asyncio.wait(pending, timeout=5))
+                for task in pending:
+                    task.cancel()
+                if pending:
+                    loop.run_until_complete(asyncio.wait(pending))
+        finally:
+            loop.close()
+
+    def start(self):
+        """Start the event loop thread, with a fresh loop and thread if it was stopped before"""
+        if self.running:
+            return
         self.running = True
-        self.loop.run_forever()
+        self.loop = asyncio.new_event_loop()
+        if self.ident is None:
+            super().start()
+        else:
+            # A thread can only be started once
+            self._thread = threading.Thread(target=self.run, daemon=self.daemon)
+            self._thread.start()
+
+    # After a restart the loop runs in self._thread, not in this Thread object
+
+    def is_alive(self):
+        if self._thread is self:
+            return super().is_alive()
+        return self._thread.is_alive()
+
+    def join(self, timeout=None):
+        if self._thread is self:
+            return super().join(timeout)
+        return self._thread.join(timeout)
 
     def run_coro(self, coro,wait_for_result=True):
         
@@ -43,13 +83,86 @@ class AsyncioEventLoopThread(threading.Thread):
         else:
             return asyncio.run_coroutine_threadsafe(coro, loop=self.loop)
 
+    def _check_running(self):
+        if not self.running:
+            print("Event loop thread is not running, use the *_async methods from your event loop.")
+        return self.running
+
+    def _run(self, coro):
+        """
+        Run the coroutine in the loop thread and return its result.
+        If called from within the loop itself (e.g. from a button handler),
+        the coroutine is scheduled as a task and the task is returned
+        instead, blocking here would deadlock the loop.
+        If the loop thread is not running, the coroutine is discarded.
+        """
+        if not self._check_running():
+            coro.close()
+            return None
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self.loop:
+            task = self.loop.create_task(coro)
+            self._tasks.add(task)
+            task.add_done_callback(self._task_done)
+            return task
+        return self.run_coro(coro)
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Command failed: %s", task.exception(), exc_info=task.exception())
+
+    def run_batch(self, *coros):
+        """Run several coroutines one after another with a single hop into the loop"""
+        if not self._check_running():
+            for coro in coros:
+                coro.close()
+            return None
+
+        async def batch():
+            pending = list(coros)
+            results = []
+            try:
+                while pending:
+                    results.append(await pending.pop(0))
+            finally:
+                # Do not leak the remaining coroutines if one of them raised
+                for coro in pending:
+                    coro.close()
+            return results
+        return self._run(batch())
+
     def stop(self):
-        self.loop.call_soon_threadsafe(self.loop.stop)
-        #self.join()
+        """Stop the loop, it is closed by the thread once pending tasks are done"""
+        if not self.running:
+            return
         self.running = False
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if threading.current_thread() is not self._thread:
+            self._thread.join(timeout=10)
 
 
 class DecentScale(AsyncioEventLoopThread):
+
+    #Constants
+    CHAR_READ='0000FFF4-0000-1000-8000-00805F9B34FB'
+    CHAR_WRITE='000036f5-0000-1000-8000-00805f9b34fb'
+
+    #Tare the scale by sending "030FFD000000F1". 
+    #Each tare needs to increment the 3rd byte pair, 
+    #so you can cycle (for instance) though "030FFE000000F2" "030FFF000000F3" "030F000000000C".
+    tare_commands=tuple(bytes.fromhex(c) for c in ['030F000000000C','030F010000000D','030F020000000E'])
+
+    # NOTE: LED_ON is Weight LED, Timer LED, Units (since v1.1)
+    # here, we send always both leds on and units == g
+    led_on_command=bytes.fromhex('030A0101000009')
+    led_off_command=bytes.fromhex('030A0000000009')
+    start_time_command=bytes.fromhex('030B030000000B')
+    stop_time_command=bytes.fromhex("030B0000000008")
+    reset_time_command=bytes.fromhex("030B020000000A" )
     
     def __init__(self, *args, timeout=20, fix_dropped_command=True, **kwargs):
         super().__init__(*args, **kwargs)
@@ -58,41 +171,53 @@ class DecentScale(AsyncioEventLoopThread):
         self.timeout=timeout
         self.connected=False
         self.fix_dropped_command=fix_dropped_command
-        self.dropped_command_sleep = 0.05  # API Docs says 50ms
+        self.command_timeout = 0.2  # upper bound to wait for the acknowledgement
+        self._pending_acks = {}  # notification type -> [asyncio.Event, number of acks still expected]
+        self._notify_ready = None  # asyncio.Event, set on the first valid notification
         self.weight = None
+        self._debug_rx = logger.isEnabledFor(logging.DEBUG)
 
         self.button_callbacks = []
 
-        #Constants
-        self.CHAR_READ='0000FFF4-0000-1000-8000-00805F9B34FB'
-        self.CHAR_WRITE='000036f5-0000-1000-8000-00805f9b34fb'
-        
-        
-        #Tare the scale by sending "030FFD000000F1". 
-        #Each tare needs to increment the 3rd byte pair, 
-        #so you can cycle (for instance) though "030FFE000000F2" "030FFF000000F3" "030F000000000C".
-        
-        tare_commands=[  bytearray.fromhex(c) for c in ['030F000000000C','030F010000000D','030F020000000E']]
-        self.tare_commands=cycle(tare_commands)
-
-        # NOTE: LED_ON is Weight LED, Timer LED, Units (since v1.1)
-        # here, we send always both leds on and units == g
-        self.led_on_command=bytearray.fromhex('030A0101000009')
-        self.led_off_command=bytearray.fromhex('030A0000000009')
-        self.start_time_command=bytearray.fromhex('030B030000000B')
-        self.stop_time_command=bytearray.fromhex("030B0000000008")
-        self.reset_time_command=bytearray.fromhex("030B020000000A" )
-        
-        super().start()
+        self._tare_idx=0  # next entry of tare_commands to send
+
+        # Notification type -> handler
+        self._notification_handlers = {
+            0xCA: self._on_weight,
+            0xCE: self._on_weight,
+            0xAA: self._on_button,
+            0x0F: self._on_ignore,  # tare increment
+            0x0A: self._on_led,
+            # Timer
+            # NOTE: The API documentation says there is a section on "Receiving Timer Info" but this is missing
+            0x0B: self._on_ignore,
+        }
+        # The loop thread is only started by find_address/connect,
+        # so that it is never spawned when only the *_async methods are used
 
     def check_connection(func):
-        def is_connected(self):
+        @functools.wraps(func)
+        def is_connected(self, *args, **kwargs):
             if self.connected:
-                func(self)
+                return func(self, *args, **kwargs)
             else:
                 print("Scale is not connected.")
         return is_connected
 
+    def stop(self):
+        """Disconnect from the scale and stop the event loop thread"""
+        if not self.running:
+            return
+        # The client is bound to the loop, it cannot be used after the loop is closed.
+        # The disconnect is scheduled on the loop (this may be the loop thread itself),
+        # the thread finishes it before closing the loop.
+        if self.connected:
+            asyncio.run_coroutine_threadsafe(self._disconnect_on_stop(self.client), loop=self.loop)
+        self.connected = False
+        self.client = None
+        self.weight = None
+        super().stop()
+
     async def _find_address(self):
         
         device = await BleakScanner.find_device_by_filter(
@@ -109,9 +234,6 @@ class DecentScale(AsyncioEventLoopThread):
         
         self.client = BleakClient(address)
         
-        if not self.running:
-            super().start()
-        
         try:
             return await self.client.connect(timeout=self.timeout)
         except Exception as e:
@@ -121,91 +243,168 @@ class DecentScale(AsyncioEventLoopThread):
     async def _disconnect(self):
         return await self.client.disconnect()   
 
-    async def __send(self, cmd):
-        """Send commands with firmware v1.0 bugfix (resending)"""
-        await self.client.write_gatt_char(self.CHAR_WRITE, cmd)
-        if self.fix_dropped_command:
-            await asyncio.sleep(self.dropped_command_sleep)
-            await self.client.write_gatt_char(self.CHAR_WRITE, cmd)
+    async def _disconnect_on_stop(self, client):
+        try:
+            await client.disconnect()
+        except Exception as e:
+            logger.warning("Disconnect on stop failed: %s", e)
 
-        # Wait 200ms for the command to finish
-        # Alternative: receive the notifications and check if the command was acknowledged
-        await asyncio.sleep(0.2)
+    async def connect_async(self, address):
+        if not self.connected:
+            self.connected = await self._connect(address)
 
-    async def _tare(self):
-        await self.__send(next(self.tare_commands))
+            if self.connected:
+                await self._init_leds()
+        else:
+            print('Already connected.')
 
-    async def _led_on(self):
-        await self.__send(self.led_on_command)
+        return self.connected
 
-    async def _led_off(self):
-        await self.__send(self.led_off_command)
+    async def disconnect_async(self):
+        if self.connected:
+            self.connected = not await self._disconnect()
+        else:
+            print('Already disconnected.')
+
+        return self.connected
+
+    async def __send(self, cmd, *, resend=None, timeout=None):
+        """
+        Send commands with firmware v1.0 bugfix (resending)
+        resend and timeout default to fix_dropped_command and command_timeout
+        """
+        if resend is None:
+            resend = self.fix_dropped_command
+        if timeout is None:
+            timeout = self.command_timeout
+
+        # The scale answers with a notification of the same type as the command
+        # A resent command is acknowledged twice, both acks have to be drained,
+        # otherwise the second one would release the next command of the same type
+        ack_type = cmd[1]
+        ack = asyncio.Event()
+        pending = [ack, 2 if resend else 1]
+        self._pending_acks[ack_type] = pending
+
+        # Write without response, so both writes can go out in the same connection interval
+        await self.client.write_gatt_char(self.CHAR_WRITE, cmd, response=False)
+        if resend:
+            await self.client.write_gatt_char(self.CHAR_WRITE, cmd, response=False)
+
+        # Wait for the acknowledgement, but at most timeout
+        # (without notifications enabled there is nothing to wait for)
+        try:
+            await asyncio.wait_for(ack.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if self._pending_acks.get(ack_type) is pending:
+                del self._pending_acks[ack_type]
+
+    async def tare_async(self):
+        cmd = self.tare_commands[self._tare_idx]
+        self._tare_idx = (self._tare_idx + 1) % len(self.tare_commands)
+        await self.__send(cmd)
+
+    # LED commands are idempotent, a dropped command does not need the resend
+
+    async def led_on_async(self):
+        await self.__send(self.led_on_command, resend=False, timeout=0.05)
 
-    async def _start_time(self):
+    async def led_off_async(self):
+        await self.__send(self.led_off_command, resend=False, timeout=0.05)
+
+    async def _init_leds(self):
+        await self.led_off_async()
+        await self.led_on_async()
+
+    async def start_time_async(self):
         await self.__send(self.start_time_command)
 
-    async def _stop_time(self):
+    async def stop_time_async(self):
         await self.__send(self.stop_time_command)
 
-    async def _reset_time(self):
+    async def reset_time_async(self):
         await self.__send(self.reset_time_command)
 
     def notification_handler(self, sender, data):
-        logger.debug(f"Received Notification at {time.time():.3f}: {binascii.hexlify(data, sep=':').decode('ascii')!r}")
+        if self._debug_rx:
+            logger.debug("Received Notification at %.3f: %r", _now(), _hexlify(data, sep=':').decode('ascii'))
 
-        if data[0] != 0x03 or len(data) != 7:
+        if len(data) != 7 or data[0] != 0x03:
             # Basic sanity check
             logger.info("Invalid notification: not a Decent Scale?")
             return
 
-        # Calculate XOR
-        xor_msg = functools.reduce(operator.xor, data[:-1])
-        if xor_msg != data[-1]:
+        # Calculate XOR (unrolled, the packet has a fixed length)
+        if (data[0] ^ data[1] ^ data[2] ^ data[3] ^ data[4] ^ data[5]) != data[6]:
             logger.warning("XOR validation failed for notification")
             return
 
-        # Have to decide by type of the package
-        type_ = data[1]
-
-        if type_ in [0xCA, 0xCE]:
-            # Weight information
-            self.weight = int.from_bytes(data[2:4], byteorder='big', signed=True) / 10
-        elif type_ == 0xAA:
-            # Button press
-            # NOTE: Despite the API documentation saying the XOR field is 0x00, it actually contains the XOR
-            logger.debug(f"Button press: {data[2]}, duration: {data[3]}")
-            # FIXME: This is not good. it crashes the event loop!
-            self._handle_buttons(data[2], data[3])
-        elif type_ == 0x0F:
-            # tare increment
-            pass
-        elif type_ == 0x0A:
-            # LED on/off -> returns units and battery level
-            logger.debug(f"Unit of scale: {'g' if data[3] == 0 else 'oz'}")
-            if data[4] <= 0x64:
-                logger.debug(f"battery level: {data[4]}%")
-            elif data[4] == 0xff:
-                logger.debug("Scale is running on USB power")
-            else:
-                logger.warning(f"Unknown battery level: 0x{data[4]:02x}")
-            if data[5] in FIRMWARE_VERSION:
-                logger.debug(f"Firmware Version: {FIRMWARE_VERSION[data[5]]}")
-            else:
-                logger.warning(f"Firmware Version is not known: 0x{data[5]:02x}")
-        elif type_ == 0x0B:
-            # Timer
-            # NOTE: The API documentation says there is a section on "Receiving Timer Info" but this is missing
-            pass
+        if self._notify_ready is not None:
+            self._notify_ready.set()
+            self._notify_ready = None
+
+        # Decode all fields at once and decide by type of the package
+        _, type_, value, byte4, byte5, _ = _PACKET_STRUCT.unpack_from(data)
+
+        pending = self._pending_acks.get(type_)
+        if pending is not None:
+            pending[1] -= 1
+            if pending[1] <= 0:
+                pending[0].set()
+
+        handler = self._notification_handlers.get(type_)
+        if handler is not None:
+            handler(value, byte4, byte5)
         else:
             logger.warning(f"Unknown Notification Type received: 0x{type_:02x}")
 
+    def _on_weight(self, value, byte4, byte5):
+        # Weight information
+        self.weight = value / 10
+
+    def _on_button(self, value, byte4, byte5):
+        # Button press
+        # NOTE: Despite the API documentation saying the XOR field is 0x00, it actually contains the XOR
+        button, duration = (value >> 8) & 0xFF, value & 0xFF
+        logger.debug("Button press: %d, duration: %d", button, duration)
+        # FIXME: This is not good. it crashes the event loop!
+        self._handle_buttons(button, duration)
+
+    def _on_led(self, value, battery, firmware):
+        # LED on/off -> returns units and battery level
+        logger.debug("Unit of scale: %s", 'g' if value & 0xFF == 0 else 'oz')
+        if battery <= 0x64:
+            logger.debug("battery level: %d%%", battery)
+        elif battery == 0xff:
+            logger.debug("Scale is running on USB power")
+        else:
+            logger.warning(f"Unknown battery level: 0x{battery:02x}")
+        if firmware in FIRMWARE_VERSION:
+            logger.debug("Firmware Version: %s", FIRMWARE_VERSION[firmware])
+        else:
+            logger.warning(f"Firmware Version is not known: 0x{firmware:02x}")
+
+    def _on_ignore(self, value, byte4, byte5):
+        pass
+
     def _handle_buttons(self, button, duration):
         for callback in self.button_callbacks:
             callback(self, button, duration)
 
-    async def _enable_notification(self):
+    async def enable_notification_async(self):
+        # The log level is only looked up here and not for every notification
+        self._debug_rx = logger.isEnabledFor(logging.DEBUG)
+        self._notify_ready = ready = asyncio.Event()
         await self.client.start_notify(self.CHAR_READ, self.notification_handler)
-        await asyncio.sleep(1)
+        # Wait until the first notification arrives, but at most 1s
+        try:
+            await asyncio.wait_for(ready.wait(), timeout=1.0)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._notify_ready = None
 
     def add_button_handler(self, callback):
         """
@@ -215,41 +414,34 @@ class DecentScale(AsyncioEventLoopThread):
         """
         self.button_callbacks.append(callback)
 
-    async def _disable_notification(self):
-        await self.client.stop_notify(self.CHAR_READ) 
+    async def disable_notification_async(self):
+        self.weight=None
+        await self.client.stop_notify(self.CHAR_READ)
 
     @check_connection    
     def enable_notification(self):   
-        return self.run_coro(self._enable_notification())
+        return self._run(self.enable_notification_async())
     
     @check_connection 
     def disable_notification(self):   
-        self.weight=None
-        return self.run_coro(self._disable_notification())
+        return self._run(self.disable_notification_async())
  
     def find_address(self):   
+        if not self.running:
+            self.start()
         return self.run_coro(self._find_address())
 
     
     def connect(self,address):
-        if not self.connected:
-            self.connected= self.run_coro(self._connect(address))
-            
-            if self.connected:
-                self.led_off()
-                self.led_on()
-        else:
-            print('Already connected.')
-    
-        return self.connected
+        if not self.running:
+            self.start()
+        return self._run(self.connect_async(address))
                 
     def disconnect(self):
-        if self.connected:
-            self.connected= not self.run_coro(self._disconnect())
-        else:
+        if not self.connected:
             print('Already disconnected.')
-        
-        return self.connected
+            return self.connected
+        return self._run(self.disconnect_async())
             
     def auto_connect(self,n_retries=3):    
         address = None
@@ -274,27 +466,27 @@ class DecentScale(AsyncioEventLoopThread):
     
     @check_connection 
     def tare(self):   
-        self.run_coro(self._tare())
+        return self._run(self.tare_async())
         
     @check_connection 
     def start_time(self):   
-        self.run_coro(self._start_time())
+        return self._run(self.start_time_async())
     
     @check_connection 
     def stop_time(self):   
-        self.run_coro(self._stop_time())
+        return self._run(self.stop_time_async())
                    
     @check_connection 
     def reset_time(self):   
-        self.run_coro(self._reset_time())
+        return self._run(self.reset_time_async())
 
     @check_connection 
     def led_off(self):   
-        self.run_coro(self._led_off())
+        return self._run(self.led_off_async())
                    
     @check_connection 
     def led_on(self):   
-        self.run_coro(self._led_on())
+        return self._run(self.led_on_async())
  
 
         